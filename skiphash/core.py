@@ -82,11 +82,7 @@ class CopyableBitArray(bitarray, flavors.Copyable, flavors.RemoteCopy):
         return CityHash(self.to01())
     
     def __int__(self):
-        bytes = self.tobytes()
-        result = 0
-        for b in bytes:
-            result = result * 256 + int(b)
-        return result
+        return int.from_bytes(self.tobytes(), 'big')
     
     def unitValue(self):
         """
@@ -96,6 +92,19 @@ class CopyableBitArray(bitarray, flavors.Copyable, flavors.RemoteCopy):
 
 pb.setUnjellyableForClass('skiphash.core.CopyableBitArray', CopyableBitArray)
 
+def randomCopyableBitArrays(byteSize: int, count: int):
+    """
+    Returns a list of `count` random CopyableBitArrays of `byteSize` bytes each,
+    drawing all of their bits from the random number generator at once.
+    """
+    byteString = random.getrandbits(8 * byteSize * count).to_bytes(byteSize * count, 'big')
+    bitArrays = []
+    for offset in range(0, byteSize * count, byteSize):
+        bitArray = CopyableBitArray()
+        bitArray.frombytes(byteString[offset:offset+byteSize])
+        bitArrays.append(bitArray)
+    return bitArrays
+
 @total_ordering
 class ComparableById:
     """
@@ -1,11 +1,11 @@
-from typing import Dict
+from typing import Dict, List
 
 from twisted.internet import defer
 from twisted.spread import flavors, pb
 
 import skiphash.skipplus as skip
 from cityhash import CityHash128
-from skiphash.core import projectOntoUnitInterval, remoteMethod
+from skiphash.core import CopyableBitArray, projectOntoUnitInterval, remoteMethod
 
 
 class Entry(flavors.Copyable, flavors.RemoteCopy):
@@ -44,8 +44,8 @@ class HashNode(skip.SkipNode):
     Extends the SkipNode class by adding distributed hash table methods.
     """
 
-    def __init__(self, port):
-        super(HashNode, self).__init__(port)
+    def __init__(self, port, rs: CopyableBitArray = None):
+        super(HashNode, self).__init__(port, rs)
         self.localHashTable = {}
         # predecessor and successor references
         self.pred = skip.lowest
@@ -121,9 +121,9 @@ class HashNode(skip.SkipNode):
             # determining the node next to unitKey (by id) without overstepping unitKey
             nextNode = None
             if unitKey < self.pred:
-                nextNode = min(x for x in self.N if x > unitKey)
+                nextNode = min(x for x in self.N.values() if x > unitKey)
             else:
-                nextNode = max(x for x in self.N if x < unitKey)
+                nextNode = max(x for x in self.N.values() if x < unitKey)
             return delegateTo(nextNode)
         else:
             if unitKey < self.unitId:
@@ -149,13 +149,23 @@ class HashNode(skip.SkipNode):
         self.localHashTable.update(hashTable)
     
     @remoteMethod
-    @defer.inlineCallbacks
     def linearise(self, u: skip.SkipNodeReference):
         skip.SkipNode.linearise(self, u)
-        # update predecessor and successor
+        return self._updatePredAndSucc()
+    
+    @remoteMethod
+    def lineariseBatch(self, us: List[skip.SkipNodeReference]):
+        skip.SkipNode.lineariseBatch(self, us)
+        return self._updatePredAndSucc()
+    
+    @defer.inlineCallbacks
+    def _updatePredAndSucc(self):
+        """
+        Updates predecessor and successor after our neighborhood has changed.
+        """
         oldPred = self.pred
-        self.pred = skip.pred(self.reference, self.N)
-        self.succ = skip.succ(self.reference, self.N)
+        self.pred = skip.pred(self.reference, self.sortedN)
+        self.succ = skip.succ(self.reference, self.sortedN)
         if self.pred != oldPred and self.pred is not skip.lowest:
             # get our entries from our new predecessor
             hashTable = yield self.pred.handOff(self.reference)
@@ -170,4 +180,4 @@ class HashNode(skip.SkipNode):
 class HashNodeFactory(skip.SkipNodeFactory):
 
     def _initNode(self, port: int, isFirstNode: bool) -> HashNode:
-        return HashNode(port)
+        return HashNode(port, self._nextRs())
@@ -1,19 +1,39 @@
 import logging
 # general skip helper functions
-from typing import Set, Union
+from typing import Dict, Iterable, List, Sequence
 
-from bitarray import bitarray
+import numpy as np
+from sortedcontainers import SortedKeyList
 from twisted.internet import defer
 from twisted.spread import pb
 
 from skiphash.core import (CopyableBitArray, Node, NodeFactory, NodeReference,
                        PseudoNodeReference, eprint, randomBitArray,
-                       remoteMethod)
+                       randomCopyableBitArrays, remoteMethod)
 
 # Define the length of the rs bit string
 RS_BYTE_LENGTH = 2
 RS_BIT_LENGTH = RS_BYTE_LENGTH * 8
 
+# number of random bit strings a SkipNodeFactory generates at once
+RS_POOL_SIZE = 64
+
+# _PREFIX_SHIFTS[i] turns an integer rs into its prefix of length i
+_PREFIX_SHIFTS = tuple(RS_BIT_LENGTH - i for i in range(RS_BIT_LENGTH+1))
+
+# minimum number of node pairs to compare with numpy instead of plain Python
+VECTORIZATION_THRESHOLD = 64
+
+# The numpy code below stores random bit strings as unsigned integers
+# and looks common prefix lengths up in a table with 2**RS_BIT_LENGTH entries.
+assert RS_BIT_LENGTH <= 16, "delegationDestinations only supports random bit strings of up to 16 bits"
+_RS_DTYPE = np.min_scalar_type(2**RS_BIT_LENGTH - 1)
+# maps each XOR of two random bit strings to the length of their common prefix
+_COMMON_PREFIX_LENGTHS = np.array([RS_BIT_LENGTH - x.bit_length() for x in range(2**RS_BIT_LENGTH)], dtype=np.uint8)
+
+# For each prefix length i, maps prefixInt(i, w) to the nodes w having that prefix
+PrefixBuckets = List[Dict[int, SortedKeyList]]
+
 lowest = PseudoNodeReference("lowest")
 highest = PseudoNodeReference("highest")
 
@@ -26,13 +46,17 @@ class SkipNodeReference(NodeReference):
     
     def __init__(self, host: str = None, port: int = None, rs: CopyableBitArray = None):
         super(SkipNodeReference, self).__init__(host, port)
-        self._rs = rs
+        self.rs = rs
     
     def getStateToCopy(self):
-        return (super(SkipNodeReference, self).getStateToCopy(), self.rs)
+        # the raw bytes are much cheaper to transfer than a jellied CopyableBitArray
+        return (super(SkipNodeReference, self).getStateToCopy(), self.rs.tobytes())
         
     def setCopyableState(self, state):
-        superState, self._rs = state
+        superState, rsBytes = state
+        self._rs = CopyableBitArray()
+        self._rs.frombytes(rsBytes)
+        self.intRs = int.from_bytes(rsBytes, 'big')
         super(SkipNodeReference, self).setCopyableState(superState)
     
     @property
@@ -45,121 +69,204 @@ class SkipNodeReference(NodeReference):
     @rs.setter
     def rs(self, rs: CopyableBitArray):
         self._rs = rs
+        # the random bit string as an unsigned integer, for fast comparisons
+        self.intRs = int.from_bytes(rs.tobytes(), 'big') if rs is not None else None
 
 pb.setUnjellyableForClass('skiphash.skipplus.SkipNodeReference', SkipNodeReference)
 
 
-def prefix(i: int, v: Union["SkipNode", SkipNodeReference, bitarray]) -> CopyableBitArray:
+def prefixInt(i: int, v: SkipNodeReference) -> int:
     """
-    Returns a copy of the first `i` bits of `v`s random
-    bit string (rs) as a bitarray.
+    Returns the first `i` bits of `v`s random bit string (rs)
+    as an unsigned integer.
     """
-    if isinstance(v, (SkipNode, SkipNodeReference)):
-        rs = v.rs
-    else:
-        rs = v
-    return rs.copy()[:i]
+    return v.intRs >> _PREFIX_SHIFTS[i]
+
+def _nodeId(v: SkipNodeReference) -> int:
+    return v.id
+
+# an empty sorted node list, never to be modified
+_noNodes = SortedKeyList(key=_nodeId)
 
-def pred(v: SkipNodeReference, W: Set[SkipNodeReference]) -> SkipNodeReference:
+def pred(v: SkipNodeReference, W: Iterable[SkipNodeReference]) -> SkipNodeReference:
     """
     pred(v, w) = arg max (w∈W ∪ {lowest}) {w < v}
+    If W is a SortedKeyList sorted by id, pred is found by bisection.
     """
+    if isinstance(W, SortedKeyList):
+        index = W.bisect_key_left(v.id)
+        return W[index-1] if index > 0 else lowest
     return max([w for w in W if w < v] + [lowest])
 
-def succ(v: SkipNodeReference, W: Set[SkipNodeReference]) -> SkipNodeReference:
+def succ(v: SkipNodeReference, W: Iterable[SkipNodeReference]) -> SkipNodeReference:
     """
     succ(v, W) = arg min (w∈W ∪ {highest}) {w > v}
+    If W is a SortedKeyList sorted by id, succ is found by bisection.
     """
-    if len(W) == 0:
-        W = []
+    if isinstance(W, SortedKeyList):
+        index = W.bisect_key_right(v.id)
+        return W[index] if index < len(W) else highest
     return min([w for w in W if w > v] + [highest])
 
-def _levelNodes(i: int, v: SkipNodeReference, x: bool, N: Set[SkipNodeReference]) -> Set[SkipNodeReference]:
+def prefixBuckets(N: Iterable[SkipNodeReference] = ()) -> PrefixBuckets:
     """
-    Returns {w ∈ N | prefix(i+1, w) = prefix(i, v)◦x}
+    Groups the nodes in N by their rs prefixes. The returned list is
+    indexed by the prefix length i and maps each prefixInt(i, w)
+    to the nodes w ∈ N having that prefix, sorted by their ids.
+    Keep it up to date via addToBuckets and removeFromBuckets
+    and pass it to the skip range functions below,
+    instead of letting them scan N over and over again.
     """
-    # get prefix(i, v)◦x
-    pref = prefix(i, v)
-    pref.append(x)
+    buckets = [{} for _ in range(RS_BIT_LENGTH+1)]
+    for w in N:
+        addToBuckets(buckets, w)
+    return buckets
 
-    # get {w ∈ N(v) | prefix(i+1, w) = prefix(i, v)◦x}
-    return set(w for w in N if prefix(i+1, w) == pref)
+def addToBuckets(buckets: PrefixBuckets, w: SkipNodeReference) -> None:
+    """
+    Inserts w into the bucket of each of its prefixes.
+    """
+    intRs = w.intRs
+    for levelBuckets, shift in zip(buckets, _PREFIX_SHIFTS):
+        key = intRs >> shift
+        bucket = levelBuckets.get(key)
+        if bucket is None:
+            bucket = levelBuckets[key] = SortedKeyList(key=_nodeId)
+        bucket.add(w)
 
-def levelPred(i: int, v: SkipNodeReference, x: bool, N: Set[SkipNodeReference]) -> SkipNodeReference:
+def removeFromBuckets(buckets: PrefixBuckets, w: SkipNodeReference) -> None:
+    """
+    Removes w from the bucket of each of its prefixes.
+    """
+    intRs = w.intRs
+    for levelBuckets, shift in zip(buckets, _PREFIX_SHIFTS):
+        key = intRs >> shift
+        bucket = levelBuckets[key]
+        bucket.remove(w)
+        if len(bucket) == 0:
+            del levelBuckets[key]
+
+def _levelNodes(i: int, v: SkipNodeReference, x: bool, buckets: PrefixBuckets) -> SortedKeyList:
+    """
+    Returns {w ∈ N | prefix(i+1, w) = prefix(i, v)◦x}
+    """
+    return buckets[i+1].get((prefixInt(i, v) << 1) | x, _noNodes)
+
+def levelPred(i: int, v: SkipNodeReference, x: bool, buckets: PrefixBuckets) -> SkipNodeReference:
     """
     levelPred(i, v, x, N) = pred(v, {w ∈ N | prefix(i+1, w) = prefix(i, v)◦x})
     """
-    return pred(v, _levelNodes(i, v, x, N))
+    return pred(v, _levelNodes(i, v, x, buckets))
 
-def levelSucc(i: int, v: SkipNodeReference, x: bool, N: Set[SkipNodeReference]) -> SkipNodeReference:
+def levelSucc(i: int, v: SkipNodeReference, x: bool, buckets: PrefixBuckets) -> SkipNodeReference:
     """
     levelSucc(i, v, x, N) = succ(v, {w ∈ N | prefix(i+1, w) = prefix(i, v)◦x})
     """
-    return succ(v, _levelNodes(i, v, x, N))
+    return succ(v, _levelNodes(i, v, x, buckets))
 
-def low(i: int, v: SkipNodeReference, N: Set[SkipNodeReference]) -> SkipNodeReference:
+def low(i: int, v: SkipNodeReference, buckets: PrefixBuckets) -> SkipNodeReference:
     """
     low(i, v, N) = min{levelPred(i, v, 0, N), levelPred(i, v, 1, N)}
     """
-    return min(levelPred(i, v, 0, N), levelPred(i, v, 1, N))
+    return min(levelPred(i, v, 0, buckets), levelPred(i, v, 1, buckets))
 
-def high(i: int, v: SkipNodeReference, N: Set[SkipNodeReference]) -> SkipNodeReference:
+def high(i: int, v: SkipNodeReference, buckets: PrefixBuckets) -> SkipNodeReference:
     """
     high(i, v, N) = max{levelPred(i, v, 0, N), levelPred(i, v, 1, N)}
     """
-    return max(levelSucc(i, v, 0, N), levelSucc(i, v, 1, N))
+    return max(levelSucc(i, v, 0, buckets), levelSucc(i, v, 1, buckets))
 
-def skipRange(i: int, v: SkipNodeReference, N: Set[SkipNodeReference]) -> Set[SkipNodeReference]:
+def skipRange(i: int, v: SkipNodeReference, buckets: PrefixBuckets) -> List[SkipNodeReference]:
     """
     range(i, v, N) = [low(i, v, N), high(i, v, N)]
+    `buckets` has to be the prefixBuckets of N.
+    The nodes are returned sorted by their ids.
+    """
+    nodes = buckets[i].get(prefixInt(i, v))
+    if nodes is None:
+        return []
+    l = low(i, v, buckets)
+    h = high(i, v, buckets)
+    return list(nodes.irange_key(l.id, h.id))
+
+def isInSkipRange(w: SkipNodeReference, i: int, v: SkipNodeReference, buckets: PrefixBuckets) -> bool:
+    """
+    Returns whether w ∈ range(i, v, N) for a node w ∈ N,
+    without building the range itself.
+    `buckets` has to be the prefixBuckets of N.
     """
-    vPrefix = prefix(i, v)
-    l = low(i, v, N)
-    h = high(i, v, N)
-    return set(w for w in N if prefix(i, w) == vPrefix and l <= w and w <= h)
+    return (prefixInt(i, w) == prefixInt(i, v)
+            and low(i, v, buckets).id <= w.id <= high(i, v, buckets).id)
 
-def filterByPrefix(i: int, v: SkipNodeReference, nodes: Set[SkipNodeReference]) -> Set[SkipNodeReference]:
+def commonPrefixLength(v: int, w: int) -> int:
     """
-    Returns {w ∈ nodes | prefix(i, w) = prefix(i, v)}
+    Returns the number of bits of the longest common prefix
+    of the random bit strings v and w, given as integers.
     """
-    vPrefix = prefix(i, v)
-    return set(w for w in nodes if prefix(i, w) == vPrefix)
+    # the highest differing bit determines the prefix length
+    return RS_BIT_LENGTH - (v ^ w).bit_length()
 
-def commonPrefixLength(v: bitarray, w: bitarray) -> int:
+def longestCommonPrefixNode(w: SkipNodeReference, W: Iterable[SkipNodeReference]) -> SkipNodeReference:
     """
-    Returns the number of bits of the longest common
-    prefix of v's and w's random bit strings.
+    Returns the SkipNodeReference of the node in W that has the longest
+    common random bit string prefix with w. Ties are broken by
+    choosing the node with the minimum id difference (the "closest" one).
     """
-    i = 0
-    while i < min(len(v), len(w)) and v[i] == w[i]:
-        i += 1
-    return i
+    wIntRs = w.intRs
+    wId = w.id
+    result = None
+    resultBitLength = resultDistance = 0
+    for x in W:
+        # the lower the highest differing bit, the longer the common prefix
+        bitLength = (x.intRs ^ wIntRs).bit_length()
+        distance = abs(x.id - wId)
+        if result is None or bitLength < resultBitLength or (bitLength == resultBitLength and distance < resultDistance):
+            result = x
+            resultBitLength = bitLength
+            resultDistance = distance
+    return result
 
-def longestCommonPrefixNodes(w: SkipNodeReference, W: Set[SkipNodeReference]) -> Set[SkipNodeReference]:
+def delegationDestinations(U: Sequence[SkipNodeReference], W: Sequence[SkipNodeReference]) -> List[SkipNodeReference]:
     """
-    Returns a set of SkipNodeReferences of the nodes in W that have
-    the longest common random bit string prefix with w.
+    Returns [longestCommonPrefixNode(u, W) for u in U], comparing
+    the random bit strings of all pairs at once with numpy.
+    For only a few pairs, the plain Python loop is used instead,
+    as setting up the numpy arrays would take longer.
     """
-    longestCommonPrefixLength = max(map(lambda x: commonPrefixLength(x.rs, w.rs), W))
-    longestCommonPrefix = prefix(longestCommonPrefixLength, w.rs)
-    return set(filter(lambda x: prefix(longestCommonPrefixLength, x.rs) == longestCommonPrefix, W))
+    if len(U) * len(W) < VECTORIZATION_THRESHOLD:
+        return [longestCommonPrefixNode(u, W) for u in U]
+    WIntRs = np.fromiter((x.intRs for x in W), dtype=_RS_DTYPE, count=len(W))
+    UIntRs = np.fromiter((u.intRs for u in U), dtype=_RS_DTYPE, count=len(U))
+    # lengths[k, j] is the common prefix length of U[k] and W[j]
+    lengths = _COMMON_PREFIX_LENGTHS[np.bitwise_xor.outer(UIntRs, WIntRs)]
+    longest = lengths.max(axis=1)
+    result = []
+    for k, u in enumerate(U):
+        # break ties by the minimum id difference
+        candidates = np.flatnonzero(lengths[k] == longest[k])
+        result.append(longestCommonPrefixNode(u, [W[j] for j in candidates]))
+    return result
 
 class SkipNode(Node):
     
-    def __init__(self, port: int):
+    def __init__(self, port: int, rs: CopyableBitArray = None):
         super(SkipNode, self).__init__(port)
-        self._rs = CopyableBitArray(randomBitArray(RS_BYTE_LENGTH)) # random bitstring
+        if rs is None:
+            rs = CopyableBitArray(randomBitArray(RS_BYTE_LENGTH))
+        self._rs = rs # random bitstring
         # the self.reference object will serve as the node's id
         # replacing the super constructor's NodeReference by a SkipNodeReference
         self.reference = SkipNodeReference(self.reference.host, port, self._rs)
-        self.N = set() # outgoing neighborhood
+        self.N = {} # outgoing neighborhood, indexed by the nodes' ids
+        # the nodes in N, bucketed by their rs prefixes
+        self._buckets = prefixBuckets()
 
-        # range for each level i < RS_BIT_LENGTH - 1
-        self.ranges = dict((i, set()) for i in range(RS_BIT_LENGTH-1)) 
+        # range for each level i < RS_BIT_LENGTH - 1, sorted by id
+        self.ranges = dict((i, []) for i in range(RS_BIT_LENGTH-1)) 
 
-        # a set of all nodes (SkipNodeReferences) that are currently
-        # in at least one of this node's ranges
-        self.nodesInRanges = set()
+        # all nodes (SkipNodeReferences) that are currently
+        # in at least one of this node's ranges, indexed by their ids
+        self.nodesInRanges = {}
     
     @remoteMethod
     def getRs(self):
@@ -174,45 +281,48 @@ class SkipNode(Node):
     def rs(self):
         return self._rs
     
+    @property
+    def sortedN(self) -> SortedKeyList:
+        """
+        The outgoing neighborhood N, sorted by id. Do not modify it!
+        """
+        # all nodes share the empty prefix
+        return self._buckets[0].get(0, _noNodes)
+    
     # "Build-Skip" methods
     
-    def updateRanges(self):
-        nodesInRanges = set()
-        for i in range(RS_BIT_LENGTH-1):
-            currentLevelRange = skipRange(i, self.reference, self.N)
-            self.ranges[i] = currentLevelRange
-            nodesInRanges.union(currentLevelRange)
-        self.nodesInRanges = nodesInRanges
+    def updateRanges(self, levels: int = RS_BIT_LENGTH-1):
+        """
+        Recomputes the ranges of the lowest `levels` levels.
+        The ranges of the remaining levels are kept as they are.
+        """
+        for i in range(levels):
+            self.ranges[i] = skipRange(i, self.reference, self._buckets)
+        self.nodesInRanges = {w.id: w for levelRange in self.ranges.values() for w in levelRange}
     
     def timeout(self):
         # Introducing this node to all of our neighbors - not mentioned on the slides.
         # Still seems to be necessary in order to guarantee strong connectedness.
-        for n in self.N:
+        for n in self.N.values():
             n.linearise(self.reference)
 
         # See Chapter 5, Slide 169 f.
+        selfId = self.reference.id
         for i in range(RS_BIT_LENGTH-1):
             # partition neighborhood of level i by left and right nodes
-            levelNeighborhood = filterByPrefix(i, self.reference, self.ranges[i])
-            leftNodes = []
-            rightNodes = []
-            for x in levelNeighborhood:
-                if x < self.reference:
-                    leftNodes.append(x)
-                if x > self.reference:
-                    rightNodes.append(x)
+            # (the range only contains nodes sharing our prefix of length i and is sorted by id)
+            levelRange = self.ranges[i]
+            leftNodes = [x for x in levelRange if x.id < selfId]
+            rightNodes = [x for x in reversed(levelRange) if x.id > selfId]
 
             # introduce nodes as shown below
             # leftNodes: v1 -> v2 -> ... -> self
             # rightNodes: self <- ... <- v(n-1) <- vn
 
-            leftNodes.sort()
-            rightNodes.sort(reverse=True)
-
             # Part a: Linearizing
             for r in (leftNodes, rightNodes):
-                for i in range(len(r)-1):
-                    r[i].linearise(r[i+1])
+                for j in range(len(r)-1):
+                    r[j].linearise(r[j+1])
                 if len(r) > 0:
                     # introduce closest node to self
                     r[-1].linearise(self.reference)
@@ -225,30 +335,56 @@ class SkipNode(Node):
                 if len(side2) > 0:
                     closestRange2Node = side2[-1] # last node in right resp. left nodes
                     for v in side1:
-                        if closestRange2Node in skipRange(i, v, self.N):
+                        if isInSkipRange(closestRange2Node, i, v, self._buckets):
                             # this node thinks that closestRange2Node is in v's range
                             v.linearise(closestRange2Node)
     
     @remoteMethod
     def linearise(self, u: SkipNodeReference):
         logger.debug("%s.linearise(%s) is called.", self, u)
+        self._linearise([u])
+    
+    @remoteMethod
+    def lineariseBatch(self, us: List[SkipNodeReference]):
+        """
+        Like linearise, but for multiple nodes at once.
+        The ranges are only updated once for all of them.
+        """
+        logger.debug("%s.lineariseBatch(%d nodes) is called.", self, len(us))
+        self._linearise(us)
+    
+    def _linearise(self, us: List[SkipNodeReference]):
         # See Chapter 5, Slide 171
-        if u != self.reference and u not in self.N:
-            self.N.add(u)
-            self.updateRanges()
-            if len(self.nodesInRanges) == 0:
-                # There are no nodes in our ranges.
-                # Let's better keep our current neighbors instead of destroying the connectedness!
-                pass
-            else:
-                undesirableNodes = self.N.difference(self.nodesInRanges) # nodes that are not in any range now
-                self.N = self.nodesInRanges # only keep the skip+ neighbors in our neighborhood
-                # delegate the undesirable nodes
-                for w in undesirableNodes:
-                    # use the longestCommonPrefixNodes with the minimum id difference (the "closest" ones)
-                    nodes = longestCommonPrefixNodes(w, self.N)
-                    delegationDestination = min(nodes, key=lambda x: abs(x.id - w.id))
-                    delegationDestination.linearise(w)
+        levels = 0 # number of levels whose ranges have to be updated
+        for u in us:
+            if u.id != self.reference.id and u.id not in self.N:
+                self.N[u.id] = u
+                addToBuckets(self._buckets, u)
+                # u can only show up in the ranges of levels i with prefix(i, u) = prefix(i, self)
+                levels = max(levels, min(commonPrefixLength(u.intRs, self.reference.intRs) + 1, RS_BIT_LENGTH-1))
+        if levels == 0:
+            return # all nodes are known already
+        self.updateRanges(levels)
+        if len(self.nodesInRanges) == 0:
+            # There are no nodes in our ranges.
+            # Let's better keep our current neighbors instead of destroying the connectedness!
+            pass
+        else:
+            # nodes that are not in any range now
+            undesirableNodes = [w for key, w in self.N.items() if key not in self.nodesInRanges]
+            self.N = self.nodesInRanges # only keep the skip+ neighbors in our neighborhood
+            for w in undesirableNodes:
+                removeFromBuckets(self._buckets, w)
+            # delegate the undesirable nodes, sending one call per destination
+            destinations = delegationDestinations(undesirableNodes, list(self.N.values()))
+            delegations = {}
+            for w, delegationDestination in zip(undesirableNodes, destinations):
+                delegations.setdefault(delegationDestination.id, (delegationDestination, []))[1].append(w)
+            for delegationDestination, ws in delegations.values():
+                if len(ws) == 1:
+                    delegationDestination.linearise(ws[0])
+                else:
+                    delegationDestination.lineariseBatch(ws)
 
 class SkipNodeFactory(NodeFactory):
     """
@@ -263,6 +399,7 @@ class SkipNodeFactory(NodeFactory):
         self._entryNodeHost = entryNodeHost
         self._entryNodePort = entryNodePort
         self.entryNodeReference = None # if configured, will store the SkipNodeReference, once the rs value has arrived
+        self._rsPool = [] # pregenerated random bit strings for new nodes
         if entryNodeHost is not None and entryNodePort is not None:
             # create a NodeReference to ask the entry node for its random bit string
             entryNodeReference = NodeReference(entryNodeHost, entryNodePort)
@@ -277,8 +414,16 @@ class SkipNodeFactory(NodeFactory):
     def _failedGettingEntryNodeRs(self, reason: str):
         logger.warn("Failed to get the entry node's random bit string! This host will not be connected to any other host.")
     
+    def _nextRs(self) -> CopyableBitArray:
+        """
+        Returns a new random bit string, refilling the pool if it is empty.
+        """
+        if len(self._rsPool) == 0:
+            self._rsPool = randomCopyableBitArrays(RS_BYTE_LENGTH, RS_POOL_SIZE)
+        return self._rsPool.pop()
+    
     def _initNode(self, port: int, isFirstNode: bool) -> Node:
-        return SkipNode(port)
+        return SkipNode(port, self._nextRs())
     
     def _postInitNode(self, node: Node, isFirstNode: bool) -> None:
         if isFirstNode:
@@ -0,0 +1,55 @@
+import socket
+
+from twisted.internet import defer
+
+from skiphash.core import sleep
+
+
+def _isUnusedPort(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.bind(('', port))
+        except OSError:
+            return False
+    return True
+
+def unusedPorts(count: int) -> int:
+    """
+    Returns the first of `count` consecutive ports that are currently unused,
+    so tests do not collide with each other or other processes.
+    """
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind(('', 0)) # let the OS pick an unused port
+            startPort = s.getsockname()[1]
+        if startPort + count <= 65536 and all(_isUnusedPort(p) for p in range(startPort, startPort + count)):
+            return startPort
+
+@defer.inlineCallbacks
+def waitForStableNeighborhoods(nodes, interval: float = 1, timeout: float = 20):
+    """
+    Returns a deferred that fires with True as soon as the
+    neighborhoods of all nodes did not change during `interval` seconds,
+    or with False if that did not happen within `timeout` seconds.
+    """
+    previous = None
+    for _ in range(int(timeout / interval)):
+        yield sleep(interval)
+        current = [set(n.N) for n in nodes]
+        if current == previous:
+            return True
+        previous = current
+    return False
+
+@defer.inlineCallbacks
+def waitFor(condition, interval: float = 0.5, timeout: float = 20):
+    """
+    Returns a deferred that fires with True as soon as `condition()`,
+    which may return a deferred, is true, or with False if that
+    did not happen within `timeout` seconds.
+    """
+    for _ in range(int(timeout / interval)):
+        if (yield condition()):
+            return True
+        yield sleep(interval)
+    return False
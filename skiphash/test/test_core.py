@@ -10,18 +10,17 @@ from twisted.python import log
 
 from skiphash import thisHost
 from skiphash.core import CopyableBitArray, Node, NodeFactory, NodeReference, randomBitArray, remoteMethod
+from skiphash.test import unusedPorts
 
 observer = log.PythonLoggingObserver()
 observer.start()
 
 # pylint: disable=maybe-no-member
 
-@pytest.fixture(scope="function")
-def nodes(caplog, mocker):
-    caplog.set_level(logging.DEBUG, logger='vaud.core')
-    caplog.set_level(logging.DEBUG, logger='twisted')
-
-    factory = NodeFactory(30000)
+@pytest.fixture(scope="module")
+def nodes():
+    # shared by all tests of this module, so the nodes are only set up once
+    factory = NodeFactory(unusedPorts(3))
     for _ in range(3):
         factory.newNode()
 
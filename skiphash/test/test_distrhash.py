@@ -7,47 +7,46 @@ from pytest_mock import mocker
 from twisted.internet import defer, reactor
 from twisted.python import log
 
-from skiphash.core import sleep
 from skiphash.distrhash import HashNode, HashNodeFactory
+from skiphash.test import unusedPorts, waitFor, waitForStableNeighborhoods
 
 observer = log.PythonLoggingObserver()
 observer.start()
 
 # pylint: disable=maybe-no-member
 
+@defer.inlineCallbacks
+def lookupValues(node: HashNode, keys):
+    """Returns a deferred firing with the values `node` looks up for `keys`, None for missing ones."""
+    results = yield defer.gatherResults([node.lookup(key) for key in keys])
+    return [result.value if result is not None else None for result in results]
+
 @pytest_twisted.inlineCallbacks
 def test_operations(caplog, mocker):
     caplog.set_level(logging.DEBUG, logger='vaud.core')
     caplog.set_level(logging.DEBUG, logger='vaud.skip')
     caplog.set_level(logging.WARN, logger='twisted')
 
-    factory = HashNodeFactory(33000)
+    factory = HashNodeFactory(unusedPorts(4))
 
     for _ in range(4):
         factory.newNode()
     
-    yield sleep(4)
-
     nodes = factory.nodes
+    assert (yield waitForStableNeighborhoods(nodes))
 
-    for i in range(4):
-        nodes[0].insert("key" + str(i), "value" + str(i))
-    
-    yield sleep(2)
-    
-    for i in range(4):
-        result = yield nodes[3].lookup("key" + str(i))
-        assert result.value == "value" + str(i)
-    
-    yield sleep(2)
+    keys = ["key" + str(i) for i in range(4)]
+    values = ["value" + str(i) for i in range(4)]
 
-    for i in range(4):
-        nodes[2].remove("key" + str(i))
+    for key, value in zip(keys, values):
+        nodes[0].insert(key, value)
     
-    yield sleep(2)
+    # insertions are not acknowledged, so wait until all of them are visible
+    assert (yield waitFor(lambda: lookupValues(nodes[3], keys).addCallback(lambda result: result == values)))
+
+    for key in keys:
+        nodes[2].remove(key)
     
-    for i in range(4):
-        result = yield nodes[1].lookup("key" + str(i))
-        assert result == None
+    assert (yield waitFor(lambda: lookupValues(nodes[1], keys).addCallback(lambda result: result == [None] * 4)))
 
     yield factory.shutdown()
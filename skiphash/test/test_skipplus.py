@@ -1,4 +1,5 @@
 import logging
+import random
 import time
 
 import pytest
@@ -7,14 +8,120 @@ from pytest_mock import mocker
 from twisted.internet import defer, reactor
 from twisted.python import log
 
-from skiphash.core import sleep
-from skiphash.skipplus import SkipNode, SkipNodeFactory, SkipNodeReference
+from skiphash.core import randomCopyableBitArrays, remoteMethod
+from skiphash.skipplus import (RS_BIT_LENGTH, RS_BYTE_LENGTH, SkipNode, SkipNodeFactory, SkipNodeReference,
+                               commonPrefixLength, delegationDestinations, prefixBuckets, prefixInt, pred,
+                               skipRange, succ)
+from skiphash.test import unusedPorts, waitForStableNeighborhoods
 
 observer = log.PythonLoggingObserver()
 observer.start()
 
 # pylint: disable=maybe-no-member
 
+@pytest.fixture
+def delegations(mocker):
+    """
+    Replaces remote linearise calls on SkipNodeReferences by recording them.
+    Yields the list of recorded (method name, destination, argument) tuples.
+    """
+    calls = []
+    def linearise(self, u):
+        calls.append(("linearise", self, u))
+    def lineariseBatch(self, us):
+        calls.append(("lineariseBatch", self, us))
+    mocker.patch.object(SkipNodeReference, "linearise", linearise, create=True)
+    mocker.patch.object(SkipNodeReference, "lineariseBatch", lineariseBatch, create=True)
+    yield calls
+
+@pytest.fixture
+def node(delegations):
+    factory = SkipNodeFactory(unusedPorts(1))
+    yield factory.newNode()
+    pytest_twisted.blockon(factory.shutdown())
+
+def randomReference(port, sharedPrefix=None):
+    """
+    Returns a SkipNodeReference with a random rs, starting with sharedPrefix if given.
+    """
+    rs = randomCopyableBitArrays(RS_BYTE_LENGTH, 1)[0]
+    if sharedPrefix is not None:
+        rs[:len(sharedPrefix)] = sharedPrefix
+    return SkipNodeReference("10.0.0.1", port, rs)
+
+def scannedRange(i, v, N):
+    """
+    range(i, v, N) computed by scanning N as defined on the slides, sorted by id.
+    """
+    levelNodes = [[w for w in N if prefixInt(i+1, w) == (prefixInt(i, v) << 1) | x] for x in (0, 1)]
+    l = min(pred(v, levelNodes[0]), pred(v, levelNodes[1]))
+    h = max(succ(v, levelNodes[0]), succ(v, levelNodes[1]))
+    return sorted(w for w in N if prefixInt(i, w) == prefixInt(i, v) and l <= w <= h)
+
+def test_incremental_ranges(node):
+    random.seed(0)
+    for port in range(1, 400):
+        # let many nodes share a prefix with the node to fill the higher levels
+        u = randomReference(port, node.rs[:random.randrange(RS_BIT_LENGTH)])
+        node._linearise([u])
+
+        N = list(node.N.values())
+        buckets = prefixBuckets(N)
+        # the incrementally maintained buckets equal the ones built from scratch
+        assert [dict((k, list(b)) for k, b in levelBuckets.items()) for levelBuckets in node._buckets] == \
+               [dict((k, list(b)) for k, b in levelBuckets.items()) for levelBuckets in buckets]
+        for i in range(RS_BIT_LENGTH-1):
+            expected = scannedRange(i, node.reference, N)
+            assert skipRange(i, node.reference, buckets) == expected
+            assert node.ranges[i] == expected
+
+def test_batched_delegation(node, delegations, mocker):
+    random.seed(2)
+    us = [randomReference(port, node.rs[:random.randrange(4)]) for port in range(1, 200)]
+    updateRanges = mocker.spy(node, "updateRanges")
+    node.lineariseBatch(us)
+    assert updateRanges.call_count == 1
+
+    N = list(node.N.values())
+    delegated = {u.id for name, destination, arg in delegations for u in (arg if name == "lineariseBatch" else [arg])}
+    # every node was either added to the neighborhood or delegated, but not both
+    assert {u.id for u in us} == set(node.N) | delegated
+    assert not set(node.N) & delegated
+
+    undesirableNodes = [u for u in us if u.id in delegated]
+    expected = {}
+    for u, destination in zip(undesirableNodes, delegationDestinations(undesirableNodes, N)):
+        expected.setdefault(destination.id, set()).add(u.id)
+    # one call per destination: plain linearise for a single node, lineariseBatch for several
+    assert len(delegations) == len(expected)
+    for name, destination, arg in delegations:
+        ws = {w.id for w in (arg if name == "lineariseBatch" else [arg])}
+        assert ws == expected[destination.id]
+        assert name == ("linearise" if len(ws) == 1 else "lineariseBatch")
+    # more delegated nodes than destinations, so some destination gets several
+    assert len(undesirableNodes) > len(N)
+    assert "lineariseBatch" in {name for name, _, _ in delegations}
+
+    # The closest nodes of each level are in the ranges, so readding a delegated node
+    # does not change the ranges, and it is delegated again, on its own.
+    del delegations[:]
+    u = undesirableNodes[0]
+    node.linearise(u)
+    assert list(node.N.values()) == N
+    assert delegations == [("linearise", delegationDestinations([u], N)[0], u)]
+
+@pytest.mark.parametrize("threshold", [0, 2**32]) # numpy resp. plain Python
+def test_delegation_destinations(mocker, threshold):
+    mocker.patch("skiphash.skipplus.VECTORIZATION_THRESHOLD", threshold)
+    random.seed(1)
+    for _ in range(100):
+        U = [randomReference(port) for port in range(random.randint(1, 5))]
+        # sharing prefixes with U[0] produces many nodes with equally long common prefixes,
+        # so the id difference has to break the ties
+        W = [randomReference(port, U[0].rs[:random.choice((2, 4, 8))]) for port in range(100, random.randint(101, 130))]
+        expected = [min(W, key=lambda x: (-commonPrefixLength(x.intRs, u.intRs), abs(x.id - u.id))) for u in U]
+        assert delegationDestinations(U, W) == expected
+
 @pytest_twisted.inlineCallbacks
 def test_local_graph(caplog, mocker):
     caplog.set_level(logging.DEBUG, logger='vaud.core')
@@ -24,11 +131,57 @@ def test_local_graph(caplog, mocker):
     # This test does not check for correctness!
     # It only tries to run some skip+ nodes ;)
 
-    factory = SkipNodeFactory(33000)
+    factory = SkipNodeFactory(unusedPorts(10))
 
     for _ in range(10):
         factory.newNode()
     
-    yield sleep(5)
+    assert (yield waitForStableNeighborhoods(factory.nodes))
+
+    yield factory.shutdown()
+
+@pytest_twisted.inlineCallbacks
+def test_neighborhood_pruning(caplog, mocker):
+    caplog.set_level(logging.DEBUG, logger='vaud.core')
+    caplog.set_level(logging.DEBUG, logger='vaud.skip')
+    caplog.set_level(logging.INFO, logger='twisted')
+
+    factory = SkipNodeFactory(unusedPorts(10))
+
+    for _ in range(10):
+        factory.newNode()
+    
+    assert (yield waitForStableNeighborhoods(factory.nodes))
+
+    references = [node.reference for node in factory.nodes]
+    for node in factory.nodes:
+        others = [w for w in references if w.id != node.reference.id]
+        # the converged neighborhood consists exactly of the nodes in the ranges over all other nodes,
+        # all others have to be delegated
+        expected = set().union(*(scannedRange(i, node.reference, others) for i in range(RS_BIT_LENGTH-1)))
+        assert set(node.N) == {w.id for w in expected}
+
+    yield factory.shutdown()
+
+@pytest_twisted.inlineCallbacks
+def test_reference_copying(caplog, mocker):
+    caplog.set_level(logging.DEBUG, logger='vaud.core')
+    caplog.set_level(logging.INFO, logger='twisted')
+
+    factory = SkipNodeFactory(unusedPorts(2))
+    n1, n2 = factory.newNode(), factory.newNode()
+
+    # add a mocked 'test' method
+    mocker.patch.object(n2, "test", create=True)
+    n2.test.return_value = n1.reference # set a reference as the return value
+    # emulating the @remoteMethod decorator
+    n2.test.is_remote_method = True
+    remoteMethod.methodNames.add("test")
+
+    # implicitly call n2.test remotely via its SkipNodeReference object
+    returnValue = yield n2.reference.test()
+    assert returnValue == n1.reference
+    assert returnValue.rs == n1.rs
+    assert returnValue.intRs == n1.reference.intRs
 
     yield factory.shutdown()
@@ -9,7 +9,7 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import GLib, Gtk
 
 from skiphash.core import Node, NodeFactory
-from skiphash.skipplus import RS_BIT_LENGTH, SkipNode, SkipNodeReference, prefix
+from skiphash.skipplus import RS_BIT_LENGTH, SkipNode, SkipNodeReference
 
 
 #color constants
@@ -84,7 +84,7 @@ class Analyzer():
             rs = node.rs
             # iterate over rs prefix length
             for prefixLength in range(1, len(rs)):
-                rsPrefix = prefix(prefixLength, rs)
+                rsPrefix = rs[:prefixLength]
                 if rsPrefix in map:
                     map[rsPrefix].append(node)
                 else: